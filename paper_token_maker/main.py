@@ -1,7 +1,8 @@
 from typing import List
 from paper_token_maker.page import Page
-from paper_token_maker.token import Token
+from paper_token_maker.token import PILLOW_SIMD, Token
 from argparse import ArgumentParser
+import logging
 import yaml
 
 def get_parser(parser=None):
@@ -13,6 +14,8 @@ def get_parser(parser=None):
 def main():
     parser = get_parser()
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.info('Pillow-SIMD build active: %s', PILLOW_SIMD)
     with open(args.config_yaml) as f:
         cfg = yaml.safe_load(f)
     tokens: List[Token] = [Token(**token_cfg) for token_cfg in cfg['tokens']]
@@ -1,6 +1,8 @@
-from collections import namedtuple
-import io
-from typing import IO, Any, Dict, List, Tuple
+from collections import deque, namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+import os
+from typing import IO, Any, Callable, Iterable, Iterator, List, Tuple
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 from reportlab.pdfgen import canvas
@@ -9,6 +11,20 @@ from reportlab.lib.utils import ImageReader
 from tqdm import tqdm
 
 Point = namedtuple('Point', ['x', 'y'])
+# adaptive_dpi never renders a token below this, however small its artwork
+MIN_ADAPTIVE_DPI = 150
+# slack for float rounding, so tokens that exactly fill a row or page still fit
+FIT_EPSILON = 1e-9
+
+def _map_ahead(executor: Executor, fn: Callable, items: Iterable, lookahead: int) -> Iterator:
+    """ like executor.map, but only keeps up to lookahead results queued at once """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > lookahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 class Page():
     def __init__(
@@ -17,11 +33,19 @@ class Page():
         pagesize=letter,
         page_margin=0.25,
         max_pages=None,
+        workers=None,
+        use_processes=False,
+        adaptive_dpi=False,
     ):
         self.dpi = dpi
         self.pagesize = pagesize
         self.page_margin = page_margin * inch
         self.max_pages = max_pages
+        self.workers = workers
+        # if True, build token images in worker processes instead of threads
+        self.use_processes = use_processes
+        # if True, don't render tokens above the resolution of their artwork
+        self.adaptive_dpi = adaptive_dpi
 
     @property
     def page_width(self) -> float:
@@ -48,8 +72,8 @@ class Page():
         return self.page_height - self.page_margin
 
     def validate_token(self, token: Token):
-        fits_horizontally = (token.image_width <= self.renderable_width)
-        fits_vertically = (token.image_height <= self.renderable_height)
+        fits_horizontally = (token.image_width <= self.renderable_width + FIT_EPSILON)
+        fits_vertically = (token.image_height <= self.renderable_height + FIT_EPSILON)
         if not fits_horizontally or not fits_vertically:
             raise ValueError(f'Token {token} does not fit on a page of size {self.renderable_width / inch} inches by {self.renderable_height / inch} inches (size excludes page margins).')
 
@@ -75,41 +99,47 @@ class Page():
         So we just do the simplest algorithm and do wrapping horizontal lines of
         tokens.
         """
-        token_groups: Dict[Any, List[Token]] = {}
-        for token in tokens:
-            ordinal = self.token_image_size_ordinal(token)
-            token_group = token_groups.get(ordinal, [])
-            token_group.append(token)
-            token_groups[ordinal] = token_group
-
-        # from largest to smallest token
+        # from largest to smallest token; sorting is stable so tokens of the
+        # same size keep the order they were given in.
+        sorted_tokens = sorted(tokens, key=self.token_image_size_ordinal, reverse=True)
+
+        page_margin = self.page_margin
+        right_margin = self.right_margin
+        bottom_margin = self.bottom_margin
         page_token_placements = []
         token_placements = []
-        x = self.page_margin
-        y = self.page_margin
+        x = page_margin
+        y = page_margin
         max_height_in_row = 0
-        for ordinal in sorted(token_groups.keys()):
-            token_group = token_groups[ordinal]
-            for token in token_group:
-                for _ in range(token.copies):
-                    self.validate_token(token)
-                    if x + token.image_width > self.right_margin:
-                        y += max_height_in_row
-                        x = self.page_margin
-                    if y + token.image_height > self.bottom_margin:
-                        page_token_placements.append(token_placements)
-                        if len(page_token_placements) == self.max_pages:
-                            print('Cannot render all of these tokens due to page limit. Doing my best.')
-                            return page_token_placements
-                        else:
-                            token_placements = []
-                            x = self.page_margin
-                            y = self.page_margin
-                            max_height_in_row = 0
-                    placement = Point(x, y)
-                    token_placements.append((placement, token))
-                    x += token.image_width
-                    max_height_in_row = max(max_height_in_row, token.image_height)
+        for token in sorted_tokens:
+            # these only depend on the token, not on which copy is placed
+            self.validate_token(token)
+            token_width = token.image_width
+            token_height = token.image_height
+            copies_left = token.copies
+            while copies_left > 0:
+                if x + token_width > right_margin + FIT_EPSILON:
+                    y += max_height_in_row
+                    x = page_margin
+                    max_height_in_row = 0
+                if y + token_height > bottom_margin + FIT_EPSILON:
+                    page_token_placements.append(token_placements)
+                    if len(page_token_placements) == self.max_pages:
+                        print('Cannot render all of these tokens due to page limit. Doing my best.')
+                        return page_token_placements
+                    else:
+                        token_placements = []
+                        x = page_margin
+                        y = page_margin
+                        max_height_in_row = 0
+                # place as many copies as fit in the rest of this row at once
+                row_copies = min(copies_left, max(1, int((right_margin - x + FIT_EPSILON) // token_width)))
+                token_placements.extend(
+                    (Point(x + i * token_width, y), token) for i in range(row_copies)
+                )
+                x += row_copies * token_width
+                copies_left -= row_copies
+                max_height_in_row = max(max_height_in_row, token_height)
 
         if len(token_placements) > 0:
             page_token_placements.append(token_placements)
@@ -118,18 +148,54 @@ class Page():
     def render(self, tokens: List[Token], output_stream_or_filename: str | IO[bytes]):
         c = canvas.Canvas(output_stream_or_filename, pagesize=self.pagesize)
         arrangement = self.arrange(tokens)
-        count = 0
-        num_tokens = sum((len(page_arrangement) for page_arrangement in arrangement))
-        with tqdm(total=num_tokens, desc='Tokens rendered') as pbar:
+        placed_tokens = [token for page_arrangement in arrangement for (_, token) in page_arrangement]
+        # copies are placed contiguously; once a token's last copy is drawn its
+        # cached images are no longer needed.
+        last_copy_index = {id(token): token_index for token_index, token in enumerate(placed_tokens)}
+
+        def build_image(indexed_token: Tuple[int, Token]):
+            token_index, token = indexed_token
+            dpi = self.dpi
+            if self.adaptive_dpi:
+                dpi = min(dpi, max(MIN_ADAPTIVE_DPI, int(token.native_dpi)))
+            return token.to_image(dpi=dpi, token_index=token_index, executor=process_pool, page_dpi=self.dpi)
+
+        # token images are independent of each other, so build them in worker
+        # threads (Pillow releases the GIL) and only draw them here, in order.
+        # with use_processes the threads hand the actual building to worker
+        # processes, while copies still share the images cached on each token.
+        if self.use_processes:
+            process_pool_context = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            process_pool_context = nullcontext()
+        with process_pool_context as process_pool, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                tqdm(total=len(placed_tokens), desc='Tokens rendered') as pbar:
+            # a bounded look-ahead keeps the workers busy without holding every
+            # built image until it is drawn.
+            lookahead = 2 * (self.workers or os.cpu_count() or 1)
+            token_images = _map_ahead(executor, build_image, enumerate(placed_tokens), lookahead)
+            token_index = 0
+            # copies share the same token image object and are drawn one after
+            # another. Reusing the previous reader means reportlab extracts the
+            # raw pixel data once rather than per copy.
+            last_token_image = last_token_image_reader = None
+            # looked up once here instead of for every placed copy
+            token_sizes = {id(token): (token.image_width, token.image_height) for token in tokens}
+            draw_image = c.drawImage
+            update_progress = pbar.update
             for page_arrangement in arrangement:
                 for (point, token) in page_arrangement:
-                    token_image = token.to_image(dpi=self.dpi, token_index=count)
-                    img_byte_io = io.BytesIO()
-                    token_image.save(img_byte_io, format='PNG')
-                    img_byte_io.seek(0)
-                    token_image_reader = ImageReader(img_byte_io)
-                    c.drawImage(token_image_reader, point.x, point.y, width=token.image_width, height=token.image_height)
-                    count += 1
-                    pbar.update(1)
+                    token_image = next(token_images)
+                    # reportlab reads PIL images directly; no need to encode them first.
+                    if token_image is not last_token_image:
+                        last_token_image = token_image
+                        last_token_image_reader = ImageReader(token_image)
+                    token_width, token_height = token_sizes[id(token)]
+                    draw_image(last_token_image_reader, point.x, point.y, width=token_width, height=token_height)
+                    if last_copy_index[id(token)] == token_index:
+                        token.clear_image_cache()
+                    token_index += 1
+                    update_progress(1)
                 c.showPage() # this draws the current page and goes to the next page
         c.save()
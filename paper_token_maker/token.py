@@ -1,7 +1,60 @@
-from typing import Dict, List, Optional, Tuple
+from collections import namedtuple
+from concurrent.futures import Executor, Future
+import functools
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import PIL
 from PIL import Image
-from PIL import ImageOps
-from reportlab.lib.units import inch
+
+# reportlab's unit (points) per inch; kept local so importing tokens doesn't
+# have to import reportlab.
+_INCH = 72.0
+# Pillow-SIMD is a drop-in fork of Pillow; its releases carry a .postN suffix.
+PILLOW_SIMD = '.post' in PIL.__version__
+# Pillow's default filter for resize(). Pillow-SIMD vectorizes it along with
+# the other convolution filters (bilinear, lanczos).
+RESAMPLE = Image.Resampling.BICUBIC
+
+# pixel geometry of a token image at one dpi. artwork_size is the size of each
+# side's artwork, front/back are the top-left corners it is pasted at.
+TokenLayout = namedtuple('TokenLayout', ['image_size', 'artwork_size', 'front', 'back'])
+
+@functools.lru_cache(maxsize=256)
+def _load_and_resize(
+        image_path: str,
+        image_size: Tuple[int, int],
+        transpose: Optional[Image.Transpose] = None,
+) -> Image:
+    """
+    Artwork at the given size, optionally flipped/rotated. Shared by every
+    token using the same artwork at the same size, so treat it as read-only.
+    """
+    if transpose is not None:
+        return _load_and_resize(image_path, image_size).transpose(transpose)
+    # the context manager releases the source file (and its full-size decode)
+    # once the resized copy is made.
+    with Image.open(image_path) as image:
+        # libjpeg can decode straight to 1/2, 1/4 or 1/8 scale, which is much
+        # cheaper than a full decode when the token is smaller. Other formats
+        # ignore this.
+        image.draft('RGB', image_size)
+        return image.convert("RGBA").resize(image_size, RESAMPLE)
+
+@functools.lru_cache(maxsize=64)
+def _load_background(
+        image_path: str,
+        image_size: Tuple[int, int],
+        transpose: Optional[Image.Transpose] = None,
+) -> Image:
+    """
+    Opaque background artwork at the given size, optionally flipped/rotated.
+    Shared like _load_and_resize, so treat it as read-only.
+    """
+    if transpose is not None:
+        return _load_background(image_path, image_size).transpose(transpose)
+    with Image.open(image_path) as image:
+        image.draft('RGB', image_size)  # only JPEGs support reduced decodes
+        return image.convert('RGB').resize(image_size, RESAMPLE)
 
 class Token():
     def __init__(
@@ -45,20 +98,38 @@ class Token():
         """
         self._front_image_path = front_image_path
         self._back_image_path = back_image_path
-        self._height = height * inch
-        self._width = width * inch
-        self._bottom_margin = bottom_margin * inch
-        self._border_thickness = border_thickness * inch
+        self._height = height * _INCH
+        self._width = width * _INCH
+        self._bottom_margin = bottom_margin * _INCH
+        self._border_thickness = border_thickness * _INCH
         self._mirror_back = mirror_back
         self._copies = copies
-        self._border_colors = border_colors
-        self._background_colors = background_colors
+        self._border_colors = self._color_list(border_colors)
+        self._background_colors = self._color_list(background_colors)
+        if isinstance(background_image_paths, str):
+            background_image_paths = [background_image_paths]
         self._background_image_paths = background_image_paths
+        # futures of rendered images keyed by everything that can differ
+        # between copies
+        self._image_cache: Dict[Any, Future] = {}
+        self._image_cache_lock = threading.Lock()
+        self._layout_cache: Dict[int, TokenLayout] = {}
+
+    def __getstate__(self):
+        # sent to worker processes without the lock or rendered images
+        state = self.__dict__.copy()
+        del state['_image_cache_lock']
+        state['_image_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._image_cache_lock = threading.Lock()
 
     def __str__(self):
         return (f"Token(front_image_path='{self._front_image_path}', "
-                f"height={self._height / inch} inches, width={self._width / inch} inches, "
-                f"border_thickness={self._border_thickness / inch} inches, ")
+                f"height={self._height / _INCH} inches, width={self._width / _INCH} inches, "
+                f"border_thickness={self._border_thickness / _INCH} inches, ")
 
     def __repr__(self):
         return (f"Token(front_image_path={repr(self._front_image_path)}, "
@@ -81,101 +152,160 @@ class Token():
     def copies(self) -> int:
         return self._copies
 
+    @functools.cached_property
+    def native_dpi(self) -> float:
+        """
+        pixels per inch of the front/back artwork at the printed token size.
+        rendering above this only upsamples the artwork.
+        """
+        native_dpi = 0
+        for image_path in (self._front_image_path, self._back_image_path or self._front_image_path):
+            with Image.open(image_path) as image:  # only reads the header
+                width, height = image.size
+            native_dpi = max(native_dpi, width / (self._width / _INCH), height / (self._height / _INCH))
+        return native_dpi
+
+    @staticmethod
+    def _color_list(colors) -> List[Tuple[int, int, int]]:
+        """ normalizes a single color or a list of colors to a list of RGB tuples """
+        if isinstance(colors[0], (int, float)):
+            colors = [colors]
+        # output needs to be tuples
+        return [(color[0], color[1], color[2]) for color in colors]
+
+    def _layout(self, dpi: int) -> TokenLayout:
+        layout = self._layout_cache.get(dpi)
+        if layout is None:
+            dpi_per_inch = dpi / _INCH  # convert reportlab inch to pixels
+            pixel_width = int(self._width * dpi_per_inch)
+            pixel_height = int(self._height * dpi_per_inch)
+            pixel_border = int(self._border_thickness * dpi_per_inch)
+            pixel_bottom_margin = int(self._bottom_margin * dpi_per_inch)
+            # front img is on bottom so that fold-crease is on top.
+            y_back = pixel_border + pixel_bottom_margin
+            y_front = y_back + pixel_border + pixel_height + pixel_border
+            layout = TokenLayout(
+                image_size=(int(self.image_width * dpi_per_inch), int(self.image_height * dpi_per_inch)),
+                artwork_size=(pixel_width, pixel_height),
+                front=(pixel_border, y_front),
+                back=(pixel_border, y_back),
+            )
+            self._layout_cache[dpi] = layout
+        return layout
+
     def _border_color(self, token_index) -> Tuple[int, int, int]:
-        try:
-            color = self._border_colors[token_index % len(self._border_colors)]
-            len(color)  # checks that it's not an int
-        except:
-            color = self._border_colors
-        # output needs to be a tuple
-        return (color[0], color[1], color[2])
+        return self._border_colors[token_index % len(self._border_colors)]
 
     def _background_color(self, token_index) -> Tuple[int, int, int]:
-        try:
-            color = self._background_colors[token_index % len(self._background_colors)]
-            len(color)  # checks that it's not an int
-        except:
-            color = self._background_colors
-        # output needs to be a tuple
-        return (color[0], color[1], color[2])
-
-    def _background_image(self, token_index: int, image_size: Tuple[int, int]) -> Image:
-        if self._background_image_paths is not None:
-            if isinstance(self._background_image_paths, str):
-                background_image_path = self._background_image_paths
-            else:
-                index = token_index % len(self._background_image_paths)
-                background_image_path = self._background_image_paths[index]
-            background_image = Image.open(background_image_path)
-            background_image = background_image.resize(image_size)
+        return self._background_colors[token_index % len(self._background_colors)]
+
+    def _background_image_path(self, token_index: int) -> Optional[str]:
+        if self._background_image_paths is None:
+            return None
+        return self._background_image_paths[token_index % len(self._background_image_paths)]
+
+    def _background_key(self, token_index: int) -> Any:
+        """ identifies the background that _background_image would produce """
+        return self._background_image_path(token_index) or self._background_color(token_index)
+
+    def _paste_side(
+            self,
+            canvas: Image,
+            artwork: Image,
+            token_index: int,
+            position: Tuple[int, int],
+            transpose: Optional[Image.Transpose] = None,
+    ) -> None:
+        """ paints the background color or image onto canvas, then the artwork over it """
+        x, y = position
+        box = (x, y, x + artwork.width, y + artwork.height)
+        background_image_path = self._background_image_path(token_index)
+        if background_image_path is not None:
+            canvas.paste(_load_background(background_image_path, artwork.size, transpose), box)
         else:
-            try:
-                color = self._background_colors[token_index % len(self._background_colors)]
-                len(color)  # checks that it's not an int
-            except:
-                color = self._background_colors
-            # only tuples accepted
-            color = (color[0], color[1], color[2])
-            background_image = Image.new('RGBA', image_size, color)
-        return background_image
-
-    def apply_background(self, image: Image, background: Image):
-        background.paste(image, (0, 0), mask=image)
-        return background
+            canvas.paste(self._background_color(token_index), box)
+        # backgrounds are opaque RGB, so alpha-over reduces to a single masked
+        # blend (artwork * a + background * (1 - a)) with no alpha to compute.
+        canvas.paste(artwork, box, mask=artwork)
 
     def set_corner_pixels_black(self, image: Image, cross_radius_px=10) -> None:
-        # Set corner pixels to black
-        right = image.width - 1
-        bottom = image.height - 1
-        pixels = image.load()
+        # Set corner pixels to black, one filled run of pixels per edge
+        width, height = image.size
+        r = cross_radius_px
         black = (0, 0, 0)
-        for i in range(cross_radius_px):
-            pixels[0, 0+i] = black  # Top-left corner
-            pixels[right-i, 0] = black  # Top-right corner
-            pixels[0+i, bottom] = black  # Bottom-left corner
-            pixels[right, bottom-i] = black  # Bottom-right corner
-            pixels[0+i, 0] = black  # Top-left corner
-            pixels[right, 0+i] = black  # Top-right corner
-            pixels[0, bottom-i] = black  # Bottom-left corner
-            pixels[right-i, bottom] = black  # Bottom-right corner
-
-    def to_image(self, dpi: int, token_index=0) -> Image:
-        dpi_per_inch = dpi / inch  # convert reportlab inch to pixels
-
-        # load front and back images, resize them, orient them.
-        front_img = Image.open(self._front_image_path).convert("RGBA")
-        back_image_path = self._back_image_path or self._front_image_path
-        back_img = Image.open(back_image_path).convert("RGBA")
-        pixel_width = int(self._width * dpi_per_inch)
-        pixel_height = int(self._height * dpi_per_inch)
-        token_pixel_dims = (pixel_width, pixel_height)
-        front_img = front_img.resize(token_pixel_dims)
-        back_img = back_img.resize(token_pixel_dims)
-
-        # apply background color or image
-        pixel_border = int(self._border_thickness * dpi_per_inch)
-        border_color = self._border_color(token_index)
-        background_image = self._background_image(token_index, token_pixel_dims)
-        front_img = self.apply_background(front_img, background_image)
-        background_image = self._background_image(token_index, token_pixel_dims)
-        back_img = self.apply_background(back_img, background_image)
-
-        # flip/mirror the back image as needed
-        back_img = ImageOps.flip(back_img)
-        if self._mirror_back:
-            back_img = ImageOps.mirror(back_img)
+        for box in (
+            (0, 0, 1, r), (0, 0, r, 1),  # Top-left corner
+            (width - r, 0, width, 1), (width - 1, 0, width, r),  # Top-right corner
+            (0, height - 1, r, height), (0, height - r, 1, height),  # Bottom-left corner
+            (width - 1, height - r, width, height), (width - r, height - 1, width, height),  # Bottom-right corner
+        ):
+            image.paste(black, box)
 
-        # stack the front and back images within the frame, apply border
-        combined_img = Image.new(
-            'RGBA',
-            (int(self.image_width * dpi_per_inch), int(self.image_height * dpi_per_inch)),
-            color=border_color,
-            )
-        # front img is on bottom so that fold-crease is on top.
-        pixel_bottom_margin = int(self._bottom_margin * dpi_per_inch)
-        y_back = pixel_border + pixel_bottom_margin
-        y_front = y_back + pixel_border + back_img.height + pixel_border
-        combined_img.paste(back_img, (pixel_border, y_back), mask=back_img)
-        combined_img.paste(front_img, (pixel_border, y_front), mask=front_img)
-        self.set_corner_pixels_black(combined_img)
+    def to_image(
+            self,
+            dpi: int,
+            token_index=0,
+            executor: Optional[Executor] = None,
+            page_dpi: Optional[int] = None,
+    ) -> Image:
+        """
+        Copies of a token only differ by their (cycled) border color and
+        background, so the image rendered for an earlier copy is reused.
+        The returned image is shared between copies; don't modify it in place.
+        If an executor (e.g. a process pool) is given, new images are built in it.
+        If the token is rendered below page_dpi, its cut marks are shortened to
+        keep the length they have at page_dpi.
+        """
+        cross_radius_px = 10
+        if page_dpi is not None and dpi < page_dpi:
+            cross_radius_px = max(1, round(cross_radius_px * dpi / page_dpi))
+        cache_key = (dpi, cross_radius_px, self._border_color(token_index), self._background_key(token_index))
+        # copies may be rendered concurrently; build each image only once. The
+        # lock only guards the lookup, so distinct images of this token are
+        # built in parallel and copies wait on the image they need only.
+        with self._image_cache_lock:
+            future = self._image_cache.get(cache_key)
+            build = future is None and executor is None
+            if future is None:
+                if executor is None:
+                    future = Future()
+                else:
+                    # submitting doesn't block, and the executor's own future
+                    # is what copies wait on.
+                    future = executor.submit(self._build_image, dpi, token_index, cross_radius_px)
+                self._image_cache[cache_key] = future
+        if build:
+            try:
+                image = self._build_image(dpi, token_index, cross_radius_px)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            future.set_result(image)
+        return future.result()
+
+    def clear_image_cache(self):
+        """ Drops the images cached by to_image, e.g. once the last copy has been drawn """
+        with self._image_cache_lock:
+            self._image_cache.clear()
+
+    def _build_image(self, dpi: int, token_index: int, cross_radius_px: int = 10) -> Image:
+        layout = self._layout(dpi)
+        # the border-colored canvas is painted on directly: each side's
+        # background first, then its artwork, so no per-side images are built.
+        # tokens are opaque throughout, so there's no alpha channel to carry.
+        combined_img = Image.new('RGB', layout.image_size, color=self._border_color(token_index))
+        front_img = _load_and_resize(self._front_image_path, layout.artwork_size)
+        self._paste_side(combined_img, front_img, token_index, layout.front)
+
+        # the back is flipped/mirrored (flip + mirror is a 180 rotation). Its
+        # artwork and background come pre-oriented from the caches, so the
+        # transposes run once per artwork rather than once per image.
+        if self._mirror_back:
+            back_transpose = Image.Transpose.ROTATE_180
+        else:
+            back_transpose = Image.Transpose.FLIP_TOP_BOTTOM
+        back_image_path = self._back_image_path or self._front_image_path
+        back_img = _load_and_resize(back_image_path, layout.artwork_size, back_transpose)
+        self._paste_side(combined_img, back_img, token_index, layout.back, back_transpose)
+        self.set_corner_pixels_black(combined_img, cross_radius_px)
         return combined_img
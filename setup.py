@@ -21,6 +21,9 @@ setuptools.setup(
         'pyyaml',
         'tqdm',
     ],
+    extras_require={
+        'simd': ['pillow-simd'],
+    },
     entry_points = {
         'console_scripts': [
             'paper_token_maker=paper_token_maker.main:main',